@@ -1,9 +1,18 @@
 import streamlit as st
 import boto3
-import json
+import gzip
+import orjson
 import os
+import tempfile
+import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+from botocore.eventstream import ParserError
 from botocore.exceptions import NoCredentialsError, ClientError, BotoCoreError
+from urllib3.exceptions import HTTPError
 from datetime import datetime
 
 # Page configuration
@@ -13,51 +22,92 @@ st.set_page_config(
     layout="wide"
 )
 
-def initialize_aws_client():
-    """Initialize AWS Bedrock client with multiple credential sources"""
+# Messages kept in memory; the full transcript is appended to disk
+MAX_MESSAGES = 500
+# Height in pixels of the scrollable chat history
+CHAT_HEIGHT = 600
+TRANSCRIPT_DIR = Path(tempfile.gettempdir()) / "pixpod"
+# Transcripts untouched for this many seconds belong to closed sessions
+TRANSCRIPT_TTL = 24 * 60 * 60
+
+_CREDENTIAL_SOURCES = {
+    'secrets': "Streamlit secrets",
+    'env': "environment variables",
+    'default': "default sources",
+}
+
+@st.cache_resource(show_spinner=False)
+def _resolve_creds_once():
+    """Read AWS credentials from Streamlit secrets or the environment a single time"""
     try:
-        # Method 1: Try Streamlit secrets first
-        if hasattr(st, 'secrets') and 'AWS_ACCESS_KEY_ID' in st.secrets:
-            client = boto3.client(
-                'bedrock-agent-runtime',
-                region_name='us-east-1',
-                aws_access_key_id=st.secrets['AWS_ACCESS_KEY_ID'],
-                aws_secret_access_key=st.secrets['AWS_SECRET_ACCESS_KEY'],
-                aws_session_token=st.secrets.get('AWS_SESSION_TOKEN')  # Optional
-            )
-            st.success("✅ AWS credentials loaded from Streamlit secrets")
-            return client
-            
-    except Exception as e:
-        st.warning(f"Streamlit secrets method failed: {e}")
+        if 'AWS_ACCESS_KEY_ID' in st.secrets:
+            return {
+                'source': 'secrets',
+                'aws_access_key_id': st.secrets['AWS_ACCESS_KEY_ID'],
+                'aws_secret_access_key': st.secrets.get('AWS_SECRET_ACCESS_KEY'),
+                'aws_session_token': st.secrets.get('AWS_SESSION_TOKEN'),  # Optional
+            }
+    except FileNotFoundError:
+        # No secrets file configured
+        pass
     
-    try:
-        # Method 2: Try environment variables
-        if os.getenv('AWS_ACCESS_KEY_ID'):
-            client = boto3.client(
-                'bedrock-agent-runtime',
-                region_name='us-east-1',
-                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-                aws_session_token=os.getenv('AWS_SESSION_TOKEN')  # Optional
-            )
-            st.success("✅ AWS credentials loaded from environment variables")
-            return client
-            
-    except Exception as e:
-        st.warning(f"Environment variables method failed: {e}")
+    if os.getenv('AWS_ACCESS_KEY_ID'):
+        return {
+            'source': 'env',
+            'aws_access_key_id': os.getenv('AWS_ACCESS_KEY_ID'),
+            'aws_secret_access_key': os.getenv('AWS_SECRET_ACCESS_KEY'),
+            'aws_session_token': os.getenv('AWS_SESSION_TOKEN'),  # Optional
+        }
     
+    # IAM role, ~/.aws/credentials, etc.
+    return {'source': 'default'}
+
+_CREDS = _resolve_creds_once()
+
+@st.cache_resource(show_spinner=False)
+def _build_bedrock_client(profile_key):
+    """Build the Bedrock client once per credential source and reuse it across reruns"""
+    # This runs on a worker thread; boto3's shared default session is not
+    # thread-safe, so each build gets its own session
+    session = boto3.Session()
+    if profile_key == 'default':
+        # Default AWS credentials (IAM role, ~/.aws/credentials, etc.)
+        return session.client('bedrock-agent-runtime', region_name='us-east-1')
+    
+    return session.client(
+        'bedrock-agent-runtime',
+        region_name='us-east-1',
+        aws_access_key_id=_CREDS['aws_access_key_id'],
+        aws_secret_access_key=_CREDS['aws_secret_access_key'],
+        aws_session_token=_CREDS['aws_session_token']
+    )
+
+def start_aws_client():
+    """Start building the Bedrock client in a background thread"""
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(_build_bedrock_client, _CREDS['source'])
+    # Let the worker thread exit once the client is built
+    executor.shutdown(wait=False)
+    return future
+
+def reset_aws_client():
+    """Forget cached credentials and clients so the next connection re-reads them"""
+    _resolve_creds_once.clear()
+    _build_bedrock_client.clear()
+    st.session_state.client = None
+
+def initialize_aws_client(future):
+    """Collect the Bedrock client built in the background and report its credential source"""
+    source = _CREDS['source']
     try:
-        # Method 3: Try default AWS credentials (IAM role, ~/.aws/credentials, etc.)
-        client = boto3.client('bedrock-agent-runtime', region_name='us-east-1')
-        # Test the connection
-        client.list_agents(maxResults=1)
-        st.success("✅ AWS credentials loaded from default sources")
-        return client
-        
-    except Exception as e:
-        st.error(f"Default credentials method failed: {e}")
+        # Credential problems surface on the first invoke_agent call
+        client = future.result()
+    except BotoCoreError as e:
+        st.error(f"Failed to create AWS client from {_CREDENTIAL_SOURCES[source]}: {e}")
         return None
+    
+    st.success(f"✅ AWS credentials loaded from {_CREDENTIAL_SOURCES[source]}")
+    return client
 
 def get_agent_config():
     """Get agent configuration from secrets or environment"""
@@ -68,63 +118,156 @@ def get_agent_config():
     try:
         agent_id = st.secrets['AGENT_ID']
         agent_alias_id = st.secrets['AGENT_ALIAS_ID']
-    except:
+    except (KeyError, FileNotFoundError):
         # Try environment variables
         agent_id = os.getenv('AGENT_ID')
         agent_alias_id = os.getenv('AGENT_ALIAS_ID')
     
     return agent_id, agent_alias_id
 
-def process_response(resp):
-    """Process the Bedrock agent response"""
-    event_stream = resp['completion']
-    try:
-        for event in event_stream:
-            if 'chunk' in event:
-                data = event['chunk']['bytes']                              
-                agent_answer = data.decode('utf8')
-                return agent_answer
-            else:
-                raise Exception("unexpected event.", event)
-    except Exception as e:
-        raise Exception("unexpected event.", e)
-
-def generate_response(client, prompt, agent_id, agent_alias_id, session_id):
-    """Generate response from Bedrock agent with error handling"""
+def iter_response(resp):
+    """Yield the Bedrock agent response text chunk by chunk as it arrives"""
+    decode = bytes.decode
+    for event in resp['completion']:
+        chunk = event.get('chunk')
+        if chunk:
+            yield decode(chunk['bytes'], 'utf-8')
+
+def invoke_agent(client, prompt, agent_id, agent_alias_id, session_id, low_latency=False,
+                 stream_final=False):
+    """Send the prompt to the Bedrock agent and return the unread response stream"""
+    # Optional settings are only sent when enabled, so the default request
+    # matches what every agent and botocore release accepts
+    options = {}
+    if low_latency:
+        options['bedrockModelConfigurations'] = {'performanceConfig': {'latency': 'optimized'}}
+    if stream_final:
+        # Without this the agent sends its final answer as a single chunk.
+        # The agent role needs bedrock:InvokeModelWithResponseStream.
+        options['streamingConfigurations'] = {'streamFinalResponse': True}
+    
+    return client.invoke_agent(
+        agentId=agent_id,
+        agentAliasId=agent_alias_id,
+        sessionId=session_id,
+        inputText=prompt,
+        **options
+    )
+
+def generate_response(client, prompt, agent_id, agent_alias_id, session_id, low_latency=False,
+                      stream_final=False):
+    """Stream the response from Bedrock agent with error handling"""
     try:
+        # Only the request itself blocks behind the spinner; the completion
+        # stream is read incrementally from the open connection afterwards
         with st.spinner("🤖 Thinking..."):
-            response = client.invoke_agent(
-                agentId=agent_id,
-                agentAliasId=agent_alias_id,
-                sessionId=session_id,
-                inputText=prompt,
+            response = invoke_agent(
+                client, prompt, agent_id, agent_alias_id, session_id, low_latency, stream_final
             )
-            
-            # Use the original parsing function
-            response_text = process_response(response)
-            return response_text if response_text else "No response received"
+        
+        yield from iter_response(response)
             
     except ClientError as e:
         error_code = e.response['Error']['Code']
         if error_code == 'AccessDeniedException':
-            return "❌ Access denied. Check your AWS permissions for Bedrock."
+            yield "❌ Access denied. Check your AWS permissions for Bedrock."
+        elif error_code in ('ExpiredTokenException', 'UnrecognizedClientException'):
+            reset_aws_client()
+            yield "❌ AWS credentials expired or invalid. Update them and retry the connection."
         elif error_code == 'ResourceNotFoundException':
-            return "❌ Agent not found. Check your Agent ID and Alias ID."
+            yield "❌ Agent not found. Check your Agent ID and Alias ID."
         else:
-            return f"❌ AWS Error: {e.response['Error']['Message']}"
+            yield f"❌ AWS Error: {e.response['Error']['Message']}"
             
     except NoCredentialsError:
-        return "❌ AWS credentials not found. Please configure credentials."
+        reset_aws_client()
+        yield "❌ AWS credentials not found. Please configure credentials."
         
-    except Exception as e:
-        return f"❌ Unexpected error: {str(e)}"
+    except BotoCoreError as e:
+        yield f"❌ AWS connection error: {str(e)}"
+    
+    # Reading the completion stream bypasses botocore's error wrapping, so
+    # dropped connections, read timeouts and malformed events arrive raw
+    except (HTTPError, ParserError) as e:
+        yield f"❌ Response stream interrupted: {str(e)}"
+
+def transcript_path():
+    """Path of the on-disk transcript for the current session"""
+    return TRANSCRIPT_DIR / f"{st.session_state.session_id}.jsonl"
+
+def prune_transcripts():
+    """Delete transcripts left behind by sessions that are no longer active"""
+    cutoff = time.time() - TRANSCRIPT_TTL
+    current = transcript_path()
+    for path in TRANSCRIPT_DIR.glob("*.jsonl"):
+        if path == current:
+            # An idle but still open session keeps its history
+            continue
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            # Removed by another session in the meantime
+            pass
+
+def append_message(role, content):
+    """Add a message to the history and keep the per-role counters in sync"""
+    message = {"role": role, "content": content}
+    # The deque drops the oldest message once full; the file keeps everything
+    st.session_state.messages.append(message)
+    with open(transcript_path(), 'ab') as f:
+        f.write(orjson.dumps(message) + b"\n")
+    st.session_state[f"{role}_msg_count"] += 1
+    # Any prepared export no longer matches the history
+    st.session_state.export_blob = None
+
+def reset_transcript():
+    """Start an empty transcript"""
+    st.session_state.messages = deque(maxlen=MAX_MESSAGES)
+    TRANSCRIPT_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    transcript_path().unlink(missing_ok=True)
+    prune_transcripts()
+    st.session_state.user_msg_count = 0
+    st.session_state.assistant_msg_count = 0
+    st.session_state.export_blob = None
+
+def render_message(message):
+    """Render a single chat message from the history"""
+    if message["role"] == "user":
+        st.chat_message("user").write(message["content"])
+    else:
+        # Use text to preserve exact formatting
+        st.chat_message("assistant").text(message["content"])
+
+def serialize_export():
+    """Serialize the chat transcript as gzip-compressed JSON, returning it with its message count"""
+    try:
+        with open(transcript_path(), 'rb') as f:
+            messages = [orjson.loads(line) for line in f]
+    except FileNotFoundError:
+        messages = []
+    
+    # The file can lose history if it was deleted or pruned; use the
+    # in-memory copy when that holds more, and let the caller report the gap
+    if len(messages) < len(st.session_state.messages):
+        messages = list(st.session_state.messages)
+    
+    chat_export = {
+        "session_id": st.session_state.session_id,
+        "timestamp": datetime.now().isoformat(),
+        "messages": messages
+    }
+    return gzip.compress(orjson.dumps(chat_export)), len(messages)
 
 # Initialize session state
 if 'session_id' not in st.session_state:
-    st.session_state.session_id = str(uuid.uuid4())
+    st.session_state.session_id = uuid.uuid4().hex
 
 if 'messages' not in st.session_state:
-    st.session_state.messages = []
+    reset_transcript()
+
+if 'agent_cfg' not in st.session_state:
+    st.session_state.agent_cfg = get_agent_config()
 
 if 'client_initialized' not in st.session_state:
     st.session_state.client_initialized = False
@@ -132,6 +275,19 @@ if 'client_initialized' not in st.session_state:
 if 'client' not in st.session_state:
     st.session_state.client = None
 
+# Warm up the AWS client while the page renders
+if 'client_future' not in st.session_state:
+    st.session_state.client_future = start_aws_client()
+
+if 'window' not in st.session_state:
+    st.session_state.window = 50
+
+if 'low_latency' not in st.session_state:
+    st.session_state.low_latency = False
+
+if 'stream_final' not in st.session_state:
+    st.session_state.stream_final = False
+
 # App header
 st.title("🤖 PixPod - Prueba de concepto")
 st.markdown("---")
@@ -145,30 +301,36 @@ with st.sidebar:
     st.code(f"Session ID: {st.session_state.session_id[:8]}...")
     
     if st.button("🔄 New Session"):
-        st.session_state.session_id = str(uuid.uuid4())
-        st.session_state.messages = []
+        transcript_path().unlink(missing_ok=True)
+        st.session_state.session_id = uuid.uuid4().hex
+        reset_transcript()
         st.rerun()
     
     # AWS Configuration
     st.subheader("☁️ AWS Status")
     
     if not st.session_state.client_initialized:
-        if st.button("🔌 Initialize AWS Client"):
-            st.session_state.client = initialize_aws_client()
+        if st.session_state.client_future.done():
+            st.session_state.client = initialize_aws_client(st.session_state.client_future)
             st.session_state.client_initialized = True
-            st.rerun()
+        else:
+            st.info("⏳ Connecting to AWS...")
     else:
         if st.session_state.client:
             st.success("✅ AWS Client Ready")
         else:
             st.error("❌ AWS Client Failed")
             if st.button("🔄 Retry Connection"):
-                st.session_state.client = initialize_aws_client()
+                # Re-read credentials so fixes made since startup are picked up
+                reset_aws_client()
+                _CREDS = _resolve_creds_once()
+                st.session_state.client_future = start_aws_client()
+                st.session_state.client_initialized = False
                 st.rerun()
     
     # Agent Configuration
     st.subheader("🤖 Agent Config")
-    agent_id, agent_alias_id = get_agent_config()
+    agent_id, agent_alias_id = st.session_state.agent_cfg
     
     if agent_id and agent_alias_id:
         st.success("✅ Agent config loaded")
@@ -178,21 +340,38 @@ with st.sidebar:
         st.error("❌ Missing agent configuration")
         st.info("Add AGENT_ID and AGENT_ALIAS_ID to secrets")
     
+    st.toggle(
+        "⚡ Low-latency mode",
+        key="low_latency",
+        help="Use Bedrock latency-optimized inference (supported models only)"
+    )
+    
+    st.toggle(
+        "🌊 Stream responses",
+        key="stream_final",
+        help="Show the answer as it is generated (agent role needs bedrock:InvokeModelWithResponseStream)"
+    )
+    
+    # Chat history
+    st.number_input(
+        "Visible messages",
+        min_value=10,
+        step=10,
+        key="window",
+        help="Older messages are hidden behind a toggle to keep reruns fast"
+    )
+    
     # Clear chat
     if st.button("🗑️ Clear Chat"):
-        st.session_state.messages = []
+        reset_transcript()
         st.rerun()
 
-# Main chat interface
-col1, col2 = st.columns([3, 1])
-
-with col1:
-    st.subheader("💬 Chat")
-
 # Check if everything is configured
 if not st.session_state.client_initialized:
-    st.warning("⚠️ Please initialize AWS client in the sidebar first.")
-    st.stop()
+    # The rest of the page is already drawn; wait for the background build
+    with st.spinner("🔌 Connecting to AWS..."):
+        wait([st.session_state.client_future])
+    st.rerun()
 
 if not st.session_state.client:
     st.error("❌ AWS client not available. Check credentials and try again.")
@@ -226,56 +405,88 @@ if not st.session_state.client:
         """)
     st.stop()
 
-agent_id, agent_alias_id = get_agent_config()
+agent_id, agent_alias_id = st.session_state.agent_cfg
 if not (agent_id and agent_alias_id):
     st.error("❌ Agent configuration missing. Check AGENT_ID and AGENT_ALIAS_ID in secrets.")
     st.stop()
 
-# Display chat history
-for i, message in enumerate(st.session_state.messages):
-    if message["role"] == "user":
-        st.chat_message("user").write(message["content"])
-    else:
-        # Use text to preserve exact formatting
-        st.chat_message("assistant").text(message["content"])
-
-# Chat input
-if prompt := st.chat_input("Type your message here..."):
-    # Add user message
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    st.chat_message("user").write(prompt)
+# Main chat interface. Running it as a fragment means chatting reruns only
+# this part of the page, not the sidebar.
+@st.fragment
+def chat_fragment(agent_id, agent_alias_id):
+    """Render the chat history, input and stats"""
+    col1, col2 = st.columns([3, 1])
     
-    # Generate response
-    response = generate_response(
-        st.session_state.client, 
-        prompt, 
-        agent_id, 
-        agent_alias_id, 
-        st.session_state.session_id
-    )
+    with col1:
+        st.subheader("💬 Chat")
     
-    # Add assistant message
-    st.session_state.messages.append({"role": "assistant", "content": response})
-    # Use text to preserve exact formatting
-    st.chat_message("assistant").text(response)
-
-# Footer with usage stats
-with col2:
-    st.subheader("📊 Stats")
-    st.metric("Messages", len(st.session_state.messages))
-    st.metric("User Messages", len([m for m in st.session_state.messages if m["role"] == "user"]))
+    # Inside a fragment st.chat_input renders inline instead of pinned to the
+    # bottom of the page, so the history scrolls in a fixed-height container
+    # to keep the input in view
+    history = st.container(height=CHAT_HEIGHT)
     
-    if st.session_state.messages:
-        st.subheader("📥 Export Chat")
-        chat_export = {
-            "session_id": st.session_state.session_id,
-            "timestamp": datetime.now().isoformat(),
-            "messages": st.session_state.messages
-        }
+    # Display chat history, only building widgets for the most recent messages
+    messages = st.session_state.messages
+    n_hidden = max(len(messages) - st.session_state.window, 0)
+    
+    with history:
+        if n_hidden and st.toggle(f"Load earlier messages ({n_hidden})", key="show_earlier"):
+            for message in islice(messages, n_hidden):
+                render_message(message)
         
-        st.download_button(
-            label="💾 Download Chat",
-            data=json.dumps(chat_export, indent=2),
-            file_name=f"chat_{st.session_state.session_id[:8]}.json",
-            mime="application/json"
-        )
\ No newline at end of file
+        for message in islice(messages, n_hidden, None):
+            render_message(message)
+    
+    # Chat input
+    if prompt := st.chat_input("Type your message here..."):
+        # Add user message
+        append_message("user", prompt)
+        history.chat_message("user").write(prompt)
+        
+        # Stream response chunks into the chat as they arrive
+        response = history.chat_message("assistant").write_stream(generate_response(
+            st.session_state.client, 
+            prompt, 
+            agent_id, 
+            agent_alias_id, 
+            st.session_state.session_id,
+            st.session_state.low_latency,
+            st.session_state.stream_final
+        ))
+        
+        # Add assistant message
+        append_message("assistant", response or "No response received")
+        
+        # A credential error dropped the client; rerun the whole app so the
+        # sidebar offers Retry Connection
+        if st.session_state.client is None:
+            st.rerun()
+    
+    # Footer with usage stats
+    with col2:
+        st.subheader("📊 Stats")
+        st.metric("Messages", st.session_state.user_msg_count + st.session_state.assistant_msg_count)
+        st.metric("User Messages", st.session_state.user_msg_count)
+        
+        if st.session_state.messages:
+            st.subheader("📥 Export Chat")
+            # Only serialize the history once an export is actually requested
+            if st.session_state.export_blob is None:
+                if st.button("📦 Prepare Export"):
+                    st.session_state.export_blob, st.session_state.export_count = serialize_export()
+            
+            if st.session_state.export_blob is not None:
+                total = st.session_state.user_msg_count + st.session_state.assistant_msg_count
+                if st.session_state.export_count < total:
+                    st.warning(
+                        f"⚠️ Part of the saved transcript was lost. "
+                        f"This export holds {st.session_state.export_count} of {total} messages."
+                    )
+                st.download_button(
+                    label="💾 Download Chat",
+                    data=st.session_state.export_blob,
+                    file_name=f"chat_{st.session_state.session_id[:8]}.json.gz",
+                    mime="application/gzip"
+                )
+
+chat_fragment(agent_id, agent_alias_id)